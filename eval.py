@@ -1,5 +1,4 @@
 import argparse
-from collections import deque
 from pathlib import Path
 
 import numpy as np
@@ -20,15 +19,22 @@ def eval(env, vae, lstm, logger, args, self_control=False, log=False, render=Fal
     assert env.num_envs == 1, "eval is only supported for num_envs = 1"
     vae.eval()
     lstm.eval()
-    obs = torch.from_numpy(np.array(env.reset())).unsqueeze(dim=1).to(args.device)
+    obs = (
+        torch.from_numpy(np.array(env.reset()))
+        .unsqueeze(dim=1)
+        .to(args.device, non_blocking=True)
+        .float()
+    )
 
     info_encoder = get_encoder()
     prev_info = info_encoder(env.env_method("get_info"))
-    latent_repr = deque(
-        np.zeros((args.num_frames, env.num_envs, vae.zdim + 4), dtype=np.float32),
-        maxlen=args.num_frames,
+    # cyclic frame stack, `head` points at the oldest frame
+    latent_repr = np.zeros(
+        (args.num_frames, env.num_envs, vae.zdim + 4), dtype=np.float32
     )
-    latent_repr.append(np.column_stack((vae.encode(obs)[0].cpu().numpy(), prev_info)))
+    head = 0
+    latent_repr[head] = np.column_stack((vae.encode(obs)[0].cpu().numpy(), prev_info))
+    head = (head + 1) % args.num_frames
     act = np.array([None])
     tot_reward = 0
 
@@ -41,14 +47,25 @@ def eval(env, vae, lstm, logger, args, self_control=False, log=False, render=Fal
         if self_control:
             obs, reward, done, info = env.step(act)
         else:
-            dist, value = lstm(torch.from_numpy(np.array(latent_repr)).to(args.device))
+            frame_idx = (np.arange(args.num_frames) + head) % args.num_frames
+            dist, value = lstm(
+                torch.as_tensor(
+                    np.take(latent_repr, frame_idx, axis=0), device=args.device
+                )
+            )
             action = to_numpy(dist.mode())
             obs, reward, done, info = env.step(action)
-            obs = torch.from_numpy(np.array(obs)).unsqueeze(dim=1).to(args.device)
+            obs = (
+                torch.from_numpy(np.array(obs))
+                .unsqueeze(dim=1)
+                .to(args.device, non_blocking=True)
+                .float()
+            )
             prev_info = info_encoder(info)
-            latent_repr.append(
-                np.column_stack((vae.encode(obs)[0].cpu().numpy(), prev_info))
+            latent_repr[head] = np.column_stack(
+                (vae.encode(obs)[0].cpu().numpy(), prev_info)
             )
+            head = (head + 1) % args.num_frames
 
         sum_reward = reward.sum()
         tot_reward += sum_reward
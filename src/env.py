@@ -382,12 +382,17 @@ class STKReward(gym.Wrapper):
 
 
 class GrayScaleObservation(gym.ObservationWrapper):
+    """
+    Converts the rendered RGB frame to a single channel `uint8` image with pixel values in
+    [0, 255]. Consumers cast the frames to float on the device without rescaling, so the VAE
+    keeps getting inputs in [0, 255].
+    """
+
     def __init__(self, env):
         super().__init__(env)
         self.observation_shape = self.env.observation_shape[:2]
         self.observation_space = Box(
-            low=np.zeros(self.observation_shape),
-            high=np.full(self.observation_shape, 255, dtype=np.float32),
+            low=0, high=255, shape=self.observation_shape, dtype=np.uint8
         )
         self.transform = T.Grayscale()
 
@@ -397,7 +402,8 @@ class GrayScaleObservation(gym.ObservationWrapper):
         return torch.from_numpy(observation)
 
     def observation(self, obs):
-        return self.transform(self.permute_orientation(obs)).squeeze(dim=0)
+        gray = self.transform(self.permute_orientation(obs)).squeeze(dim=0)
+        return gray.round_().to(torch.uint8)
 
 
 class SkipFrame(gym.Wrapper):
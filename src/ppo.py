@@ -1,22 +1,52 @@
-from collections import deque
+import math
 
 import numpy as np
 import torch
-import torch.nn.functional as F
-from scipy.signal import lfilter
 from stable_baselines3.common.vec_env import SubprocVecEnv
 from tqdm import tqdm, trange
 
 from .utils import get_encoder
 
 
+@torch.jit.script
+def gae_scan(x: torch.Tensor, discount: float) -> torch.Tensor:
+    # reverse scan over the time axis, every env column at once
+    acc = torch.zeros_like(x[0])
+    out = torch.empty_like(x)
+    for t in range(x.shape[0] - 1, -1, -1):
+        acc = x[t] + discount * acc
+        out[t] = acc
+    return out
+
+
+@torch.compile
+def ppo_loss(
+    logp_new, logp_old, adv, returns, value_new, entropy, eps, crit_coef, ent_coef
+):
+    # compiled so the elementwise ops of the clipped objective fuse into few kernels,
+    # without cuda graphs since the tail minibatch changes size with every rollout
+    ratio = (logp_new - logp_old).exp()
+    surr1 = ratio * adv
+    surr2 = torch.clamp(ratio, 1 - eps, 1 + eps) * adv
+
+    actor_loss = -torch.min(surr1, surr2).mean()
+    critic_loss = crit_coef * (value_new.squeeze(dim=-1) - returns).pow(2).mean()
+    entropy_loss = ent_coef * entropy.mean()
+    loss = actor_loss + critic_loss - entropy_loss
+    return loss, actor_loss, critic_loss, entropy_loss
+
+
 class PPOBuffer:
     """
     Buffer to store all the (s, a, r, s`) for each step taken.
     """
 
-    def __init__(self, buf_size, num_envs, zdim, act_dim, num_frames, gamma, lam):
+    def __init__(
+        self, buf_size, num_envs, zdim, act_dim, num_frames, gamma, lam, device
+    ):
         self.ptr = 0
+        self.device = device
+        self.pin_memory = torch.device(device).type == "cuda"
         self.buf_size = buf_size
         self.num_frames = num_frames
         self.num_envs = num_envs
@@ -25,27 +55,42 @@ class PPOBuffer:
         self.zdim = zdim
         self.lam = lam
         self.calculated_gae = False
-        self.reset()
+
+        # latents are produced on the device, so keep them there
+        self.obs = torch.zeros(
+            (self.buf_size, self.num_envs, self.zdim),
+            dtype=torch.float32,
+            device=self.device,
+        )
+        # pinned host memory so the copies to and from the device can run async
+        host_zeros = lambda *shape: torch.zeros(
+            shape, dtype=torch.float32, pin_memory=self.pin_memory
+        )
+        self.actions = host_zeros(self.buf_size, self.num_envs, len(self.act_dim))
+        self.log_probs = host_zeros(self.buf_size, self.num_envs)
+
+        # gae is computed on the device, keep its inputs and outputs there
+        device_zeros = lambda *shape: torch.zeros(
+            shape, dtype=torch.float32, device=self.device
+        )
+        self.rewards = device_zeros(self.buf_size, self.num_envs)
+        self.returns = device_zeros(self.buf_size, self.num_envs)
+        self.values = device_zeros(self.buf_size + 1, self.num_envs)
+        self.advantage = device_zeros(self.buf_size, self.num_envs)
         # self.test_discounted_sum()
         # self.test_gae()
 
     def reset(self):
-        self.obs = np.zeros((self.buf_size, self.num_envs, self.zdim), dtype=np.float32)
-        self.actions = np.zeros(
-            (self.buf_size, self.num_envs, len(self.act_dim)), dtype=np.float32
-        )
-        self.rewards = np.zeros((self.buf_size, self.num_envs), dtype=np.float32)
-        self.returns = np.zeros((self.buf_size, self.num_envs), dtype=np.float32)
-        self.values = np.zeros((self.buf_size + 1, self.num_envs), dtype=np.float32)
-        self.log_probs = np.zeros((self.buf_size, self.num_envs), dtype=np.float32)
-        self.advantage = np.zeros((self.buf_size, self.num_envs), dtype=np.float32)
+        # the storage is reused, `save` overwrites [0, ptr) and nothing past ptr is read
+        self.ptr = 0
+        self.calculated_gae = False
 
     def save(self, obs, act, reward, value, log_prob):
-        self.obs[self.ptr] = obs
-        self.actions[self.ptr] = act
-        self.rewards[self.ptr] = reward
-        self.values[self.ptr] = value
-        self.log_probs[self.ptr] = log_prob
+        self.obs[self.ptr].copy_(obs)
+        self.actions[self.ptr].copy_(act, non_blocking=True)
+        self.rewards[self.ptr].copy_(torch.as_tensor(reward))
+        self.values[self.ptr].copy_(value)
+        self.log_probs[self.ptr].copy_(log_prob, non_blocking=True)
         self.ptr += 1
 
     def discounted_sum(self, x, discount):
@@ -57,14 +102,28 @@ class PPOBuffer:
         output:
             [[x0 + discount * x1 + discount^2 * x2, x1 + discount * x2, x2]
              [y0 + discount * y1 + discount^2 * y2, y1 + discount * y2, y2]]
+
+        sum_{k>=t} d^(k-t) x[k] = d^-t * sum_{k>=t} d^k x[k], so the scan becomes a
+        reverse cumsum. That only holds while x * d^t stays well clear of the subnormal
+        range of the dtype of x, so d^t keeps a margin of 1 / eps above the smallest
+        normal and longer buffers (or smaller discounts) fall back to the sequential
+        scan.
         """
-        return np.flip(lfilter([1], [1, -discount], np.flip(x, axis=0), axis=0), axis=0)
+        discount = min(discount, 1.0)
+        num_steps = x.shape[0]
+        finfo = torch.finfo(x.dtype)
+        if discount ** (num_steps - 1) < finfo.tiny / finfo.eps:
+            return gae_scan(x, discount)
+
+        disc = discount ** torch.arange(num_steps, dtype=x.dtype, device=x.device)
+        disc = disc.unsqueeze(dim=1)
+        return torch.flip(torch.cumsum(torch.flip(x * disc, [0]), dim=0), [0]) / disc
 
     def test_discounted_sum(self):
         test_vals = np.random.rand(20, 5)
         calc_vals = np.zeros((20, 5))
         buf_size = test_vals.shape[0] - 1
-        actual = self.discounted_sum(test_vals, self.gamma)
+        actual = self.discounted_sum(torch.from_numpy(test_vals), self.gamma).numpy()
 
         for batch in range(test_vals.shape[-1]):
             prev_val = 0
@@ -86,7 +145,9 @@ class PPOBuffer:
         dels = np.zeros((10, 5))
 
         actual_dels = rews + (self.gamma * vals[1:] * masks) - vals[:-1]
-        actual_advs = self.discounted_sum(actual_dels, self.gamma * self.lam)
+        actual_advs = self.discounted_sum(
+            torch.from_numpy(actual_dels), self.gamma * self.lam
+        ).numpy()
 
         for batch in range(rews.shape[-1]):
             gae = 0
@@ -107,62 +168,81 @@ class PPOBuffer:
     def compute_gae(self, next_value, dones):
         # https://www.reddit.com/r/reinforcementlearning/comments/s18hjr/comment/hs7i2pa
         # https://www.reddit.com/r/reinforcementlearning/comments/sa6hho/why_do_we_need_value_networks
-        self.values[self.ptr] = next_value
-        masks = np.ones_like(self.rewards, dtype=np.float32)
-        masks[-1, dones] = 0
-        deltas = (
-            self.rewards + (self.gamma * self.values[1:] * masks) - self.values[:-1]
+        # only [0, ptr) belongs to this rollout, the rest may be left from an older one
+        rewards, values = self.rewards[: self.ptr], self.values[: self.ptr + 1]
+        advantage, returns = self.advantage[: self.ptr], self.returns[: self.ptr]
+
+        values[-1] = next_value
+        deltas = rewards + self.gamma * values[1:] - values[:-1]
+        # don't bootstrap from the next value at the last step of finished envs
+        dones = torch.as_tensor(dones, dtype=torch.float32, device=self.device)
+        deltas[-1] -= self.gamma * values[-1] * dones
+        advantage.copy_(self.discounted_sum(deltas, self.gamma * self.lam))
+        returns.copy_(self.discounted_sum(rewards, self.gamma))
+        advantage.sub_(advantage.mean(dim=0)).div_(
+            advantage.std(dim=0, unbiased=False) + 1e-5
         )
-        self.advantage = self.discounted_sum(deltas, self.gamma * self.lam)
-        self.returns = self.discounted_sum(self.rewards, self.gamma)
-        self.advantage = (self.advantage - self.advantage.mean(axis=0)) / (
-            self.advantage.std(axis=0) + 1e-5
+        # .item() syncs the stream, so the async copies queued by `save` have landed
+        self.var_returns_val = (
+            (returns - values[:-1]).var(dim=1, unbiased=False).mean().item()
         )
-        self.var_returns_val = np.mean(np.var(self.returns - self.values[:-1], axis=1))
-        self.mean_val = np.mean(np.sum(self.values, axis=1))
+        self.mean_val = values.sum(dim=1).mean().item()
         self.calculated_gae = True
-        del self.values
 
     def can_train(self):
         return (self.ptr - self.num_frames - 1) > 0
 
     def get_stats(self):
         assert self.calculated_gae, "Calculate GAE before calling this function"
+        returns = self.returns[: self.ptr]
         return (
-            np.mean(self.rewards),
-            np.mean(self.returns),
-            np.mean(self.advantage),
+            self.rewards[: self.ptr].mean().item(),
+            returns.mean().item(),
+            self.advantage[: self.ptr].mean().item(),
             self.mean_val,
-            self.var_returns_val / np.var(self.returns),
+            self.var_returns_val / returns.var(unbiased=False).item(),
         )
 
     def get_ptr(self):
         return self.ptr
 
-    def get(self):
-        # i could prolly increase the batch_size by collapsing the 0th and 1st axis of the whole
-        # buffer, but then it would bring in way too many dim changes all over the place, the code
-        # would get really messy everywhere.
-        idx = np.random.randint(low=self.num_frames, high=self.ptr)
-        idx_range = slice(idx - self.num_frames, idx)
-        return (
-            idx,
-            self.obs[idx_range],
-            self.actions[idx],
-            self.returns[idx],
-            self.log_probs[idx],
-            self.advantage[idx],
-        )
+    def num_minibatches(self, minibatch_size):
+        return math.ceil((self.ptr - self.num_frames) / minibatch_size)
+
+    def iter_minibatches(self, minibatch_size):
+        """
+        Yields shuffled minibatches that visit every timestep in [num_frames, ptr) once.
+        The envs are collapsed into the batch dim, so the frame stacks come out as
+        (num_frames, minibatch_size * num_envs, zdim).
+        """
+        idxs = np.random.permutation(np.arange(self.num_frames, self.ptr))
+        frame_offsets = torch.arange(-self.num_frames, 0).unsqueeze(dim=1)
+        to_device = lambda x: x.to(self.device, non_blocking=True).flatten(end_dim=1)
+
+        for idx in torch.from_numpy(idxs).split(minibatch_size):
+            frames = (frame_offsets + idx).to(self.obs.device)
+            yield (
+                idx,
+                self.obs[frames].flatten(start_dim=1, end_dim=2),
+                to_device(self.actions[idx]),
+                to_device(self.returns[idx]),
+                to_device(self.log_probs[idx]),
+                to_device(self.advantage[idx]),
+            )
 
 
 class PPO:
 
     EPOCHS = 2
+    MINIBATCH_SIZE = 8
     GAMMA = 0.9
     LAMBDA = 0.95
     EPSILON = 0.2
     ENTROPY_BETA = 0.2
     CRITIC_DISCOUNT = 0.5
+    TARGET_KL = 0.02
+    GRAD_ACCUM_STEPS = 4
+    MAX_GRAD_NORM = 0.5
 
     def __init__(
         self,
@@ -184,12 +264,67 @@ class PPO:
         self.opt = optimizer
         self.device = device
         self.logger = logger
-        self.info_encoder = get_encoder()
+        encoder = get_encoder()
+        self.info_encoder = lambda infos: torch.from_numpy(encoder(infos)).to(device)
         buffer_args["gamma"], buffer_args["lam"] = PPO.GAMMA, PPO.LAMBDA
+        buffer_args["device"] = device
         self.buffer = PPOBuffer(**buffer_args)
         self.num_frames = buffer_args["num_frames"]
         self.zdim, self.buf_size = buffer_args["zdim"], buffer_args["buf_size"]
 
+        # ring buffer of the last `num_frames` latents, oldest frame at `self.head`
+        ring_shape = (self.num_frames, buffer_args["num_envs"], self.zdim)
+        self.latent_ring = torch.zeros(ring_shape, device=device)
+        self.head = 0
+
+        # the vae encoder is replayed from a cuda graph, captured on the first rollout
+        self.use_cuda_graph = torch.device(device).type == "cuda"
+        self.encoder_graph, self.static_obs, self.static_z = None, None, None
+
+    def set_env(self, env: SubprocVecEnv):
+        # the buffers and the captured encoder graph are kept across envs
+        self.env = env
+
+    def _capture_encoder(self, obs):
+        # https://pytorch.org/docs/stable/notes/cuda.html#cuda-graphs
+        self.static_obs = torch.empty_like(obs, dtype=torch.float32)
+        self.static_obs.copy_(obs)
+        self.static_z = torch.empty(
+            (obs.size(0), self.vae.zdim), dtype=torch.float32, device=self.device
+        )
+
+        # warm up on a side stream before capturing
+        stream = torch.cuda.Stream()
+        stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(stream):
+            for _ in range(3):
+                self.vae.encode(self.static_obs)
+        torch.cuda.current_stream().wait_stream(stream)
+
+        self.encoder_graph = torch.cuda.CUDAGraph()
+        with torch.cuda.graph(self.encoder_graph):
+            self.static_z.copy_(self.vae.encode(self.static_obs)[0])
+
+    def _encode(self, obs):
+        """
+        Returns the latent mean of `obs`. With cuda graphs the returned tensor is
+        overwritten by the next call, so consume it before encoding again.
+        """
+        if not self.use_cuda_graph:
+            return self.vae.encode(obs)[0]
+        if self.encoder_graph is None:
+            self._capture_encoder(obs)
+        self.static_obs.copy_(obs, non_blocking=True)
+        self.encoder_graph.replay()
+        return self.static_z
+
+    def _push_latent(self, latent):
+        self.latent_ring[self.head].copy_(latent)
+        self.head = (self.head + 1) % self.num_frames
+
+    def _stacked_latents(self):
+        return torch.roll(self.latent_ring, -self.head, dims=0)
+
     @torch.no_grad()
     def rollout(self):
 
@@ -198,70 +333,55 @@ class PPO:
         obs = (
             torch.from_numpy(np.array(self.env.reset()))
             .unsqueeze(dim=1)
-            .to(self.device)
+            .to(self.device, non_blocking=True)
+            .float()
         )
         info = self.info_encoder(self.env.env_method("get_info"))
-        latent_repr = deque(
-            np.zeros(
-                (self.num_frames, self.env.num_envs, self.zdim),
-                dtype=np.float32,
-            ),
-            maxlen=self.num_frames,
-        )
+        self.buffer.reset()
+        self.latent_ring.zero_()
+        self.head = 0
         step, dones = 0, [False for _ in range(self.env.num_envs)]
-        latent_repr.append(
-            np.column_stack((self.vae.encode(obs)[0].cpu().numpy(), info))
-        )
+        latent = torch.cat((self._encode(obs), info), dim=1)
+        self._push_latent(latent)
 
         def to_numpy(x):
             return x.to(device="cpu").numpy()
 
         for step in trange(self.buf_size):
 
-            dist, value = self.lstm(
-                torch.from_numpy(np.array(latent_repr)).to(self.device)
-            )
+            dist, value = self.lstm(self._stacked_latents())
             action = dist.sample()
             log_prob = dist.log_prob(action)
 
             obs, reward, done, info = self.env.step(to_numpy(action))
-            obs = torch.from_numpy(np.array(obs)).unsqueeze(dim=1).to(self.device)
+            obs = (
+                torch.from_numpy(np.array(obs))
+                .unsqueeze(dim=1)
+                .to(self.device, non_blocking=True)
+                .float()
+            )
             info = self.info_encoder(info)
 
-            latent_repr.append(
-                np.column_stack((self.vae.encode(obs)[0].cpu().numpy(), info))
-            )
-            self.buffer.save(
-                latent_repr[-1],
-                to_numpy(action),
-                reward,
-                to_numpy(value.squeeze(dim=-1)),
-                to_numpy(log_prob),
-            )
+            latent = torch.cat((self._encode(obs), info), dim=1)
+            self._push_latent(latent)
+            self.buffer.save(latent, action, reward, value.squeeze(dim=-1), log_prob)
 
             self.logger.log_rollout_step(np.mean(reward), value.detach().cpu().mean())
             if done.any():
                 dones = done
                 break
 
-        print("-------------------------------------------------------------")
         print(f"Trajectory cut off at {step+1} time steps")
-        race_infos = np.array(self.env.env_method("get_info"))
-        env_infos = np.array(self.env.env_method("get_env_info"))
-
+        race_infos = self.env.env_method("get_info")
+        env_infos = self.env.env_method("get_env_info")
         for env_info, race_info in zip(env_infos, race_infos):
-            for key, value in env_info.items():
-                print(f"{key}: {value}")
-            print(f'done: {race_info["done"]}')
-            print(f'velocity: {race_info["velocity"]}')
-            print(f'overall_distance: {race_info["overall_distance"]}')
-            print()
-        print("-------------------------------------------------------------\n")
-
-        _, next_value = self.lstm(
-            torch.from_numpy(np.array(latent_repr)).to(self.device)
-        )
-        self.buffer.compute_gae(to_numpy(next_value.squeeze(dim=-1)), dones)
+            env_id = env_info.pop("id")
+            for key in ("done", "velocity", "overall_distance"):
+                env_info[key] = race_info[key]
+            self.logger.log_rollout_env(env_id, env_info)
+
+        _, next_value = self.lstm(self._stacked_latents())
+        self.buffer.compute_gae(next_value.squeeze(dim=-1), dones)
         (
             avg_rewards,
             avg_returns,
@@ -277,45 +397,46 @@ class PPO:
 
         self.vae.train()
         self.lstm.train()
-        to_cuda = lambda x: (
-            torch.from_numpy(x).to(
-                device=torch.device(self.device), dtype=torch.float32
-            )
-            if isinstance(x, np.ndarray)
-            else x
-        )
         if not self.buffer.can_train():
             print("Buffer size is too small")
             return
 
+        early_stop = False
+        num_batches = self.buffer.num_minibatches(PPO.MINIBATCH_SIZE)
         for epoch in trange(PPO.EPOCHS):
-            t = tqdm((range(self.buffer.get_ptr() // self.env.num_envs)))
-            for timestep in t:
+            t = tqdm(
+                self.buffer.iter_minibatches(PPO.MINIBATCH_SIZE), total=num_batches
+            )
+            self.opt.zero_grad(set_to_none=True)
+            for i, (idx, latent_repr, act, returns, logp_old, adv) in enumerate(t):
 
-                self.opt.zero_grad()
-                idx, latent_repr, act, returns, logp_old, adv = map(
-                    to_cuda, self.buffer.get()
-                )
                 dist, value_new = self.lstm(latent_repr, idx)
                 logp_new = dist.log_prob(act)
 
-                ratio = (logp_new - logp_old).exp()
-                surr1 = ratio * adv
-                surr2 = torch.clamp(ratio, 1 + PPO.EPSILON, 1 - PPO.EPSILON) * adv
-
-                actor_loss = -torch.min(surr1, surr2).mean()
-                critic_loss = (
-                    PPO.CRITIC_DISCOUNT * ((value_new.squeeze() - returns) ** 2).mean()
-                )
-                entropy_loss = PPO.ENTROPY_BETA * dist.entropy().mean()
-
-                loss = actor_loss + critic_loss - entropy_loss
-                loss.backward()
-                self.opt.step()
-
-                kl_div = F.kl_div(
-                    logp_old, logp_new, log_target=True, reduction="batchmean"
+                loss, actor_loss, critic_loss, entropy_loss = ppo_loss(
+                    logp_new,
+                    logp_old,
+                    adv,
+                    returns,
+                    value_new,
+                    dist.entropy(),
+                    PPO.EPSILON,
+                    PPO.CRITIC_DISCOUNT,
+                    PPO.ENTROPY_BETA,
                 )
+                # step once every `GRAD_ACCUM_STEPS` minibatches
+                (loss / PPO.GRAD_ACCUM_STEPS).backward()
+                if (i + 1) % PPO.GRAD_ACCUM_STEPS == 0 or i + 1 == num_batches:
+                    torch.nn.utils.clip_grad_norm_(
+                        self.lstm.parameters(), PPO.MAX_GRAD_NORM
+                    )
+                    self.opt.step()
+                    self.opt.zero_grad(set_to_none=True)
+
+                # http://joschu.net/blog/kl-approx.html
+                with torch.no_grad():
+                    logratio = logp_new - logp_old
+                    approx_kl = ((logratio.exp() - 1) - logratio).mean().item()
 
                 t.set_description(f"loss: {loss}")
                 self.logger.log_train(
@@ -323,5 +444,12 @@ class PPO:
                     critic_loss.item(),
                     entropy_loss.item(),
                     loss.item(),
-                    kl_div.item(),
+                    approx_kl,
                 )
+                if approx_kl > PPO.TARGET_KL:
+                    early_stop = True
+                    break
+
+            if early_stop:
+                print(f"Early stopping at epoch {epoch+1}, kl: {approx_kl:.4f}")
+                break
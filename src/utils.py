@@ -139,6 +139,15 @@ class Logger:
         )
         self.rollout_global_step += 1
 
+    def log_rollout_env(self, env_id, env_info):
+        # logged at the step of the upcoming `log_rollout` call
+        for key, value in env_info.items():
+            tag = f"rollout_env_{env_id}/{key}"
+            if isinstance(value, str):
+                self.writer.add_text(tag, value, self.rollout_global_step)
+            else:
+                self.writer.add_scalar(tag, value, self.rollout_global_step)
+
     def log_train(self, actor_loss, critic_loss, entropy_loss, loss, kl_div):
         self.writer.add_scalar("train/entropy_loss", entropy_loss, self.train_step)
         self.writer.add_scalar("train/policy_loss", actor_loss, self.train_step)
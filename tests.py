@@ -90,6 +90,55 @@ def test_ppo():
     print("src/ppo.py test successful")
 
 
+def test_gae():
+
+    import numpy as np
+    import torch
+
+    from src.ppo import PPO, PPOBuffer
+
+    # 20 steps takes the cumsum path, 555 falls back to the scan at gamma * lambda
+    NUM_ENVS, STEPS, DEVICE = 5, (20, 400, 555), "cpu"
+
+    def reference_sum(x, discount):
+        out, acc = np.zeros_like(x), np.zeros(x.shape[1])
+        for t in reversed(range(x.shape[0])):
+            acc = x[t] + discount * acc
+            out[t] = acc
+        return out
+
+    for num_steps in STEPS:
+        buffer = PPOBuffer(
+            num_steps, NUM_ENVS, 1, (2,), 1, PPO.GAMMA, PPO.LAMBDA, DEVICE
+        )
+        discount = PPO.GAMMA * PPO.LAMBDA
+
+        # small deltas, the ones that underflowed with too little headroom
+        deltas = np.random.rand(num_steps, NUM_ENVS) * 1e-4
+        actual = buffer.discounted_sum(torch.from_numpy(deltas).float(), discount)
+        expected = reference_sum(deltas, discount)
+        np.testing.assert_allclose(actual.numpy(), expected, rtol=1e-4)
+
+        rews = np.random.rand(num_steps, NUM_ENVS)
+        vals = np.random.rand(num_steps + 1, NUM_ENVS)
+        dones = np.random.rand(NUM_ENVS) > 0.5
+        buffer.rewards.copy_(torch.from_numpy(rews))
+        buffer.values.copy_(torch.from_numpy(vals))
+        buffer.ptr = num_steps
+        buffer.compute_gae(torch.from_numpy(vals[-1]).float(), dones)
+
+        masks = np.ones_like(rews)
+        masks[-1, dones] = 0
+        dels = rews + PPO.GAMMA * vals[1:] * masks - vals[:-1]
+        advs = reference_sum(dels, discount)
+        advs = (advs - advs.mean(axis=0)) / (advs.std(axis=0) + 1e-5)
+        np.testing.assert_allclose(buffer.advantage.numpy(), advs, atol=1e-4)
+        np.testing.assert_allclose(
+            buffer.returns.numpy(), reference_sum(rews, PPO.GAMMA), rtol=1e-4
+        )
+    print("src/ppo.py gae test successful")
+
+
 def test_vae_model():
 
     import torch
@@ -121,4 +170,5 @@ if __name__ == "__main__":
     test_env()
     test_model()
     test_ppo()
+    test_gae()
     test_vae_model()
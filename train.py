@@ -67,6 +67,8 @@ def main(args):
     optimizer = optim.Adam(lstm.parameters(), lr=args.lr, eps=1e-5)
     writer = SummaryWriter(log_dir=args.log_dir)
     logger = Logger(writer)
+    # one instance for the whole run, so its buffers are reused by every rollout
+    ppo = PPO(None, vae, lstm, optimizer, logger, args.device, **buf_args)
 
     for i in trange(args.num_global_steps):
         torch.cuda.empty_cache()
@@ -82,7 +84,7 @@ def main(args):
             ],
             start_method="spawn",
         )
-        ppo = PPO(env, vae, lstm, optimizer, logger, args.device, **buf_args)
+        ppo.set_env(env)
 
         try:
             ppo.rollout()
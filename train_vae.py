@@ -45,6 +45,12 @@ CLASS_COLOR = (
     .flatten()
     .tolist()
 )
+# grayscale value of every semantic class, using PIL's fixed point "L" conversion
+GRAY_LUT = np.zeros(256, dtype=np.uint8)
+GRAY_LUT[: len(CLASS_COLOR) // 3] = (
+    np.array(CLASS_COLOR, dtype=np.int64).reshape((-1, 3)) @ [19595, 38470, 7471]
+    + 0x8000
+) >> 16
 
 
 class ResidualBlock(nn.Module):
@@ -97,21 +103,41 @@ class VQVAE(nn.Module):
         self.embeddings = nn.Embedding(num_embeddings, embedding_dim)
         self.embeddings.weight.data.uniform_(-1 / num_embeddings, 1 / num_embeddings)
 
-    def forward(self, x):
-        z_e = self.encoder(x)
-        z_e_flattened = (
-            z_e.permute(0, 2, 3, 1).contiguous().view(-1, self.embedding_dim)
+        # squared norm of every code, only changes on optimizer steps
+        self.register_buffer(
+            "_cb_sqnorm", torch.empty(num_embeddings), persistent=False
         )
+        self.update_codebook_sqnorm()
 
-        distances = (
-            torch.sum(z_e_flattened**2, dim=1, keepdim=True)
-            + torch.sum(self.embeddings.weight**2, dim=1)
-            - 2 * (z_e_flattened @ self.embeddings.weight.t())
-        )
-        encoding_indices = torch.argmin(distances, dim=1).unsqueeze(1)
-        z_q = self.embeddings(encoding_indices).view(z_e.size())
+    @torch.no_grad()
+    def update_codebook_sqnorm(self):
+        """
+        Call after every change to the codebook, ie. optimizer steps and weight loads.
+        """
+        self._cb_sqnorm.copy_(self.embeddings.weight.pow(2).sum(dim=1))
 
-        return self.decoder(z_q), z_e, z_q
+    def forward(self, x):
+        z_e = self.encoder(x)
+        z_e_nhwc = z_e.permute(0, 2, 3, 1)
+        z_e_flattened = z_e_nhwc.reshape(-1, self.embedding_dim)
+
+        # pick the codes in fp32, reduced precision distances can flip the argmin
+        with torch.autocast(device_type=x.device.type, enabled=False):
+            # ||z_e||^2 is the same for every code, so it is left out of the argmin
+            distances = torch.addmm(
+                self._cb_sqnorm,
+                z_e_flattened.float(),
+                self.embeddings.weight.t(),
+                alpha=-2.0,
+            )
+            encoding_indices = distances.argmin(dim=1)
+        z_q = F.embedding(encoding_indices, self.embeddings.weight)
+        z_q = z_q.view(z_e_nhwc.shape).permute(0, 3, 1, 2)
+
+        # the decoder overshoots the input by a few pixels at the bottom/right edges
+        # (545x961 for 540x960), crop it back instead of resampling
+        recon = self.decoder(z_q)[:, :, : x.size(2), : x.size(3)]
+        return recon, z_e, z_q
 
 
 class CustomImageDataset(Dataset):
@@ -129,11 +155,6 @@ class CustomImageDataset(Dataset):
         return image
 
 
-def cmap_semantic_image(img: Image.Image) -> np.ndarray:
-    img.putpalette(CLASS_COLOR)
-    return np.array(img.convert("L"))
-
-
 def get_pystk_configs(
     num_players: int,
 ) -> Tuple[pystk.GraphicsConfig, pystk.RaceConfig]:
@@ -195,17 +216,15 @@ def generate_data(
 
         if random.random() < sample_rate:
             samples += race_config.num_kart
-            for kart_render_data in race.render_data:
-                img = np.array(
-                    Image.fromarray(kart_render_data.image).convert("L")
-                ) / np.float32(255.0)
-                depth = kart_render_data.depth.astype(np.float32)
-                semantic = (kart_render_data.instance >> 24) & 0xFF
-                semantic = cmap_semantic_image(
-                    Image.fromarray(semantic.astype(np.uint8))
-                ) / np.float32(255.0)
-                data = np.stack((img, depth, semantic))
-                datas.append(data)
+            render_datas = race.render_data
+            imgs = np.stack(
+                [np.array(Image.fromarray(r.image).convert("L")) for r in render_datas]
+            ) / np.float32(255.0)
+            depths = np.stack([r.depth for r in render_datas]).astype(np.float32)
+            semantics = GRAY_LUT[
+                np.stack([(r.instance >> 24) & 0xFF for r in render_datas])
+            ] / np.float32(255.0)
+            datas.extend(np.stack((imgs, depths, semantics), axis=1))
 
         steps += 1
         delta_d = steps * race_config.step_size - (time.time() - t0)
@@ -219,6 +238,18 @@ def generate_data(
     result_queue.put(np.array(datas))
 
 
+def start_data_generation(
+    num_players: int, result_queue: mp.Queue, max_samples: int
+) -> mp.Process:
+    graphic_config, race_config = get_pystk_configs(num_players)
+    process = mp.Process(
+        target=generate_data,
+        args=(graphic_config, race_config, result_queue, random.random(), max_samples),
+    )
+    process.start()
+    return process
+
+
 def log_train_verbose(
     logger: SummaryWriter,
     epoch: int,
@@ -302,10 +333,18 @@ def save_model(
 
 def main(args):
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    # the input shape is fixed, let cudnn autotune its (NHWC) conv kernels
+    torch.backends.cudnn.benchmark = True
     criterion = nn.MSELoss()
-    model = VQVAE().to(device)
+    model = VQVAE().to(device, memory_format=torch.channels_last)
     optimizer = optim.Adam(model.parameters(), lr=args.lr)
 
+    # mixed precision, bf16 where supported, otherwise fp16 with loss scaling
+    use_amp = device.type == "cuda"
+    use_bf16 = use_amp and torch.cuda.is_bf16_supported()
+    amp_dtype = torch.bfloat16 if use_bf16 else torch.float16
+    scaler = torch.cuda.amp.GradScaler(enabled=use_amp and not use_bf16)
+
     tensorboard_file_name = args.log_dir.joinpath("vae")
     logger = SummaryWriter(tensorboard_file_name, flush_secs=30)
 
@@ -315,6 +354,7 @@ def main(args):
         checkpoint = torch.load(args.model_path)
         start_epoch = checkpoint["epoch"]
         model.load_state_dict(checkpoint["model_state_dict"])
+        model.update_codebook_sqnorm()
         optimizer.load_state_dict(checkpoint["optimizer_state_dict"])
     elif args.model_path and not args.model_path.exists():
         print(f"{args.model_path} does not exist")
@@ -326,33 +366,37 @@ def main(args):
     )
 
     epochs = 1000
-    result_queue = mp.Queue()
+    train_queue, eval_queue = mp.Queue(), mp.Queue()
     epoch_progress_bar = tqdm(range(start_epoch, epochs), position=0, desc="Loss: inf")
 
+    # the samples are swapped every epoch, so the loader stays in process to see them
+    dataset, dataloader = None, None
+    # the data for the next epoch is generated while the current one trains
+    data_process = start_data_generation(
+        args.num_players, train_queue, args.max_samples
+    )
+
     for epoch in epoch_progress_bar:
         if epoch != start_epoch and epoch % args.eval_interval == 0:
             model.eval()
-            graphic_config, race_config = get_pystk_configs(args.num_players)
-            process = mp.Process(
-                target=generate_data,
-                args=(graphic_config, race_config, result_queue, random.random(), 16),
-            )
-            process.start()
-            orig_imgs = result_queue.get()
+            eval_process = start_data_generation(args.num_players, eval_queue, 16)
+            orig_imgs = eval_queue.get()
+            eval_process.join()
             orig_imgs = torch.from_numpy(orig_imgs)
-            with torch.no_grad():
+            with torch.no_grad(), torch.autocast(
+                device.type, dtype=amp_dtype, enabled=use_amp
+            ):
                 recon_imgs = (
                     torch.cat(
                         [
-                            F.interpolate(
-                                model(batch_imgs.cuda())[0],
-                                (INPUT_HEIGHT, INPUT_WIDTH),
-                                mode="nearest",
-                            ).squeeze(dim=1)
+                            model(
+                                batch_imgs.to(device, memory_format=torch.channels_last)
+                            )[0].squeeze(dim=1)
                             for batch_imgs in orig_imgs.split(args.batch_size)
                         ]
                     )
                     .unsqueeze(1)
+                    .float()
                     .cpu()
                 ).numpy()
             log_eval_tensorboard(logger, epoch, orig_imgs.numpy(), recon_imgs)
@@ -363,26 +407,25 @@ def main(args):
             )
 
         # collect data
-        graphic_config, race_config = get_pystk_configs(args.num_players)
-        process = mp.Process(
-            target=generate_data,
-            args=(
-                graphic_config,
-                race_config,
-                result_queue,
-                random.random(),
-                args.max_samples,
-            ),
-        )
-        process.start()
-        orig_imgs = result_queue.get()
+        orig_imgs = train_queue.get()
+        data_process.join()
+        if epoch + 1 < epochs:
+            data_process = start_data_generation(
+                args.num_players, train_queue, args.max_samples
+            )
         if args.verbose:
             log_train_verbose(logger, epoch, orig_imgs)
-        orig_imgs = torch.from_numpy(orig_imgs)
-        dataset = CustomImageDataset(orig_imgs, transform=None)
-        dataloader = DataLoader(
-            dataset, batch_size=args.batch_size, shuffle=True, num_workers=1
-        )
+        if dataloader is None:
+            # built on the first samples, RandomSampler rejects an empty dataset
+            dataset = CustomImageDataset(torch.from_numpy(orig_imgs), transform=None)
+            dataloader = DataLoader(
+                dataset,
+                batch_size=args.batch_size,
+                shuffle=True,
+                pin_memory=device.type == "cuda",
+            )
+        else:
+            dataset.image_datas = torch.from_numpy(orig_imgs)
         dataloader_len = len(dataloader)
 
         # setup training
@@ -394,21 +437,24 @@ def main(args):
 
         # train
         for batch_idx, images in enumerate(dataloader_progress_bar):
-            images = images.to(device)
+            images = images.to(
+                device, non_blocking=True, memory_format=torch.channels_last
+            )
             grayscale_images = images[:, 0, :, :]
             optimizer.zero_grad()
 
-            outputs, z_e, z_q = model(images)
-            recon_imgs = F.interpolate(
-                outputs, (INPUT_HEIGHT, INPUT_WIDTH), mode="nearest"
-            ).squeeze(dim=1)
-            recon_loss = criterion(recon_imgs, grayscale_images)
-            commitment_loss = torch.mean((z_e - z_q.detach()) ** 2)
-            vq_loss = torch.mean((z_q - z_e.detach()) ** 2)
-            loss = recon_loss + commitment_loss + vq_loss
-
-            loss.backward()
-            optimizer.step()
+            with torch.autocast(device.type, dtype=amp_dtype, enabled=use_amp):
+                outputs, z_e, z_q = model(images)
+                recon_loss = criterion(outputs.squeeze(dim=1), grayscale_images)
+                commitment_loss = torch.mean((z_e - z_q.detach()) ** 2)
+                vq_loss = torch.mean((z_q - z_e.detach()) ** 2)
+                loss = recon_loss + commitment_loss + vq_loss
+
+            # the scaler is a passthrough for bf16
+            scaler.scale(loss).backward()
+            scaler.step(optimizer)
+            scaler.update()
+            model.update_codebook_sqnorm()
             lr_scheduler.step()
             # torch.cuda.empty_cache()
             batch_loss = loss.item()